@@ -33,7 +33,23 @@
 
 # COMMAND ----------
 
-raw_data = spark.read.format("delta").load("/databricks-datasets/nyctaxi-with-zipcodes/subsampled")
+from pyspark import StorageLevel
+
+# Keep only the columns used downstream and cache them, since raw_data is reused for every feature and training step.
+raw_data = (
+    spark.read.format("delta")
+    .load("/databricks-datasets/nyctaxi-with-zipcodes/subsampled")
+    .select(
+        "tpep_pickup_datetime",
+        "tpep_dropoff_datetime",
+        "pickup_zip",
+        "dropoff_zip",
+        "fare_amount",
+        "trip_distance",
+    )
+    .persist(StorageLevel.MEMORY_AND_DISK)
+)
+raw_data.count()
 display(raw_data)
 
 # COMMAND ----------
@@ -48,7 +64,7 @@ display(raw_data)
 # MAGIC
 # MAGIC #### Drop off features
 # MAGIC 1. Count of trips (time window = 30 minutes)
-# MAGIC 1. Does trip end on the weekend (custom feature using python code)
+# MAGIC 1. Does trip end on the weekend (custom feature using a Spark SQL expression)
 # MAGIC
 # MAGIC <img src="https://docs.databricks.com/_static/images/machine-learning/feature-store/taxi_example_computation_v5.png"/>
 # MAGIC
@@ -59,29 +75,62 @@ display(raw_data)
 
 # COMMAND ----------
 
+from contextlib import contextmanager
 from databricks import feature_store
 from pyspark.sql.functions import *
-from pyspark.sql.types import FloatType, IntegerType, StringType
-from pytz import timezone
+from pyspark.sql.types import FloatType, IntegerType
+
+# Let adaptive query execution coalesce small or empty shuffle partitions at runtime.
+spark.conf.set("spark.sql.adaptive.enabled", "true")
+spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+
 
+@contextmanager
+def shuffle_partitions(num_partitions):
+    # Temporarily override the shuffle partition count, restoring the previous value afterwards.
+    previous = spark.conf.get("spark.sql.shuffle.partitions")
+    spark.conf.set("spark.sql.shuffle.partitions", str(num_partitions))
+    try:
+        yield
+    finally:
+        spark.conf.set("spark.sql.shuffle.partitions", previous)
 
-@udf(returnType=IntegerType())
-def is_weekend(dt):
+
+def is_weekend(ts_col):
+    # Native column expression rather than a Python UDF, so the projection stays in whole-stage codegen.
+    # If a feature needs Python logic that Spark functions can't express, write it as a vectorized
+    # @pandas_udf over a pd.Series rather than a row-at-a-time @udf, so rows reach Python in Arrow batches.
     tz = "America/New_York"
-    return int(dt.astimezone(timezone(tz)).weekday() >= 5)  # 5 = Saturday, 6 = Sunday
-  
-@udf(returnType=StringType())  
-def partition_id(dt):
-    # datetime -> "YYYY-MM"
-    return f"{dt.year:04d}-{dt.month:02d}"
+    day = dayofweek(from_utc_timestamp(ts_col, tz))
+    return when(day.isin(1, 7), lit(1)).otherwise(lit(0)).cast(IntegerType())  # 1 = Sunday, 7 = Saturday
+
+
+def write_feature_partition(table_name, df, yyyy_mm):
+    """
+    Replaces the yyyy_mm partition of a feature table's Delta table with df.
+    Use instead of fs.write_table(..., mode="merge") when df's primary keys can't already exist in other partitions,
+    since a partition replace skips the merge's match scan against the existing rows. The write goes around the
+    Feature Store client, so no lineage or data source metadata is recorded for it.
+    """
+    (
+        df.write.format("delta")
+        .mode("overwrite")
+        .option("replaceWhere", f"yyyy_mm = '{yyyy_mm}'")
+        .saveAsTable(table_name)
+    )
 
 
 def filter_df_by_ts(df, ts_column, start_date, end_date):
-    if ts_column and start_date:
-        df = df.filter(col(ts_column) >= start_date)
-    if ts_column and end_date:
-        df = df.filter(col(ts_column) < end_date)
-    return df
+    # Both bounds go into a single predicate, applied with one filter call.
+    if not ts_column:
+        return df
+    predicate = None
+    if start_date:
+        predicate = col(ts_column) >= start_date
+    if end_date:
+        upper = col(ts_column) < end_date
+        predicate = upper if predicate is None else predicate & upper
+    return df if predicate is None else df.filter(predicate)
 
 
 # COMMAND ----------
@@ -98,18 +147,36 @@ def pickup_features_fn(df, ts_column, start_date, end_date):
     df = filter_df_by_ts(
         df, ts_column, start_date, end_date
     )
+    # 1 hour window, sliding every 15 minutes. Aggregate each trip into a single 15 minute bucket first, then
+    # add every bucket to the four 1 hour windows that contain it, so only the small bucket aggregates are
+    # replicated rather than every input row.
+    pickup_buckets = (
+        df.groupBy(window("tpep_pickup_datetime", "15 minutes"), "pickup_zip")
+        .agg(
+            sum("fare_amount").alias("sum_fare"),
+            count("fare_amount").alias("count_fare"),
+            count("*").alias("count_trips"),
+        )
+        .select(
+            "pickup_zip",
+            explode(
+                array(*[col("window.end") + expr(f"INTERVAL {15 * i} MINUTES") for i in range(4)])
+            ).alias("window_end"),
+            "sum_fare",
+            "count_fare",
+            "count_trips",
+        )
+    )
     pickupzip_features = (
-        df.groupBy(
-            "pickup_zip", window("tpep_pickup_datetime", "1 hour", "15 minutes")
-        )  # 1 hour window, sliding every 15 minutes
+        pickup_buckets.groupBy("window_end", "pickup_zip")
         .agg(
-            mean("fare_amount").alias("mean_fare_window_1h_pickup_zip"),
-            count("*").alias("count_trips_window_1h_pickup_zip"),
+            (sum("sum_fare") / sum("count_fare")).alias("mean_fare_window_1h_pickup_zip"),
+            sum("count_trips").alias("count_trips_window_1h_pickup_zip"),
         )
         .select(
             col("pickup_zip").alias("zip"),
-            unix_timestamp(col("window.end")).alias("ts").cast(IntegerType()),
-            partition_id(to_timestamp(col("window.end"))).alias("yyyy_mm"),
+            unix_timestamp(col("window_end")).alias("ts").cast(IntegerType()),
+            date_format(col("window_end"), "yyyy-MM").alias("yyyy_mm"),
             col("mean_fare_window_1h_pickup_zip").cast(FloatType()),
             col("count_trips_window_1h_pickup_zip").cast(IntegerType()),
         )
@@ -125,27 +192,37 @@ def dropoff_features_fn(df, ts_column, start_date, end_date):
         df,  ts_column, start_date, end_date
     )
     dropoffzip_features = (
-        df.groupBy("dropoff_zip", window("tpep_dropoff_datetime", "30 minute"))
+        df.groupBy(window("tpep_dropoff_datetime", "30 minute"), "dropoff_zip")
         .agg(count("*").alias("count_trips_window_30m_dropoff_zip"))
         .select(
             col("dropoff_zip").alias("zip"),
             unix_timestamp(col("window.end")).alias("ts").cast(IntegerType()),
-            partition_id(to_timestamp(col("window.end"))).alias("yyyy_mm"),
+            date_format(col("window.end"), "yyyy-MM").alias("yyyy_mm"),
             col("count_trips_window_30m_dropoff_zip").cast(IntegerType()),
             is_weekend(col("window.end")).alias("dropoff_is_weekend"),
         )
     )
     return dropoffzip_features  
 
+def compute_all_features(df, start_date, end_date):
+    """
+    Computes both the pickup_features and dropoff_features feature groups for the same time range.
+    Each group is filtered on its own timestamp column; pass the cached raw_data so both read from memory.
+    """
+    pickup_features = pickup_features_fn(
+        df, ts_column="tpep_pickup_datetime", start_date=start_date, end_date=end_date
+    )
+    dropoff_features = dropoff_features_fn(
+        df, ts_column="tpep_dropoff_datetime", start_date=start_date, end_date=end_date
+    )
+    return pickup_features, dropoff_features
+
 # COMMAND ----------
 
 from datetime import datetime
 
-pickup_features = pickup_features_fn(
-    raw_data, ts_column="tpep_pickup_datetime", start_date=datetime(2016, 1, 1), end_date=datetime(2016, 1, 31)
-)
-dropoff_features = dropoff_features_fn(
-    raw_data, ts_column="tpep_dropoff_datetime", start_date=datetime(2016, 1, 1), end_date=datetime(2016, 1, 31)
+pickup_features, dropoff_features = compute_all_features(
+    raw_data, start_date=datetime(2016, 1, 1), end_date=datetime(2016, 1, 31)
 )
 
 # COMMAND ----------
@@ -179,26 +256,26 @@ fs = feature_store.FeatureStoreClient()
 
 import random
 
-# Reducing number of partitions of data shuffle.
-spark.conf.set("spark.sql.shuffle.partitions", "5")
-
 pickup_feature_table_name = f"{database_name}.trip_pickup_features_{random.randint(0, 10000)}"
-fs.create_table(
-    name=pickup_feature_table_name,
-    primary_keys=["zip", "ts"],
-    df=pickup_features,
-    partition_columns="yyyy_mm",
-    description="Taxi Fares. Pickup Features",
-)
-
 dropoff_feature_table_name = f"{database_name}.trip_dropoff_features_{random.randint(0, 10000)}"
-fs.create_table(
-    name=dropoff_feature_table_name,
-    primary_keys=["zip", "ts"],
-    df=dropoff_features,
-    partition_columns="yyyy_mm",
-    description="Taxi Fares. Dropoff Features",
-)
+
+# Reducing number of partitions of data shuffle, only for the small feature table writes.
+with shuffle_partitions(5):
+    fs.create_table(
+        name=pickup_feature_table_name,
+        primary_keys=["zip", "ts"],
+        df=pickup_features,
+        partition_columns="yyyy_mm",
+        description="Taxi Fares. Pickup Features",
+    )
+
+    fs.create_table(
+        name=dropoff_feature_table_name,
+        primary_keys=["zip", "ts"],
+        df=dropoff_features,
+        partition_columns="yyyy_mm",
+        description="Taxi Fares. Dropoff Features",
+    )
 
 # COMMAND ----------
 
@@ -212,6 +289,8 @@ fs.create_table(
 # MAGIC
 # MAGIC Use the `write_table` function to update the feature table values.
 # MAGIC
+# MAGIC When the new values fall entirely within a `yyyy_mm` partition that holds no existing keys, as the February features below do, the partition can instead be replaced directly with a Delta `replaceWhere` overwrite. This avoids the primary key match scan of `mode="merge"`, but it writes to the Delta table around the Feature Store client, so Feature Store records no lineage or data source metadata for that write. Below, the pickup features are written with `write_table` and the dropoff features with a partition replace.
+# MAGIC
 # MAGIC <img src="https://docs.databricks.com/_static/images/machine-learning/feature-store/taxi_example_compute_and_write.png"/>
 
 # COMMAND ----------
@@ -220,35 +299,28 @@ display(raw_data)
 
 # COMMAND ----------
 
-# Compute the pickup_features feature group.
-pickup_features_df = pickup_features_fn(
-  df=raw_data,
-  ts_column="tpep_pickup_datetime",
-  start_date=datetime(2016, 2, 1),
-  end_date=datetime(2016, 2, 29),
-)
-
-# Write the pickup features DataFrame to the feature store table
-fs.write_table(
-  name=pickup_feature_table_name,
-  df=pickup_features_df,
-  mode="merge",
-)
+start_date = datetime(2016, 2, 1)
+yyyy_mm = start_date.strftime("%Y-%m")
 
-# Compute the dropoff_features feature group.
-dropoff_features_df = dropoff_features_fn(
+# Compute the pickup_features and dropoff_features feature groups.
+pickup_features_df, dropoff_features_df = compute_all_features(
   df=raw_data,
-  ts_column="tpep_dropoff_datetime",
-  start_date=datetime(2016, 2, 1),
+  start_date=start_date,
   end_date=datetime(2016, 2, 29),
 )
 
-# Write the dropoff features DataFrame to the feature store table
-fs.write_table(
-  name=dropoff_feature_table_name,
-  df=dropoff_features_df,
-  mode="merge",
-)
+# Reducing number of partitions of data shuffle, only for the small feature table writes.
+with shuffle_partitions(5):
+    # Write the pickup features DataFrame to the feature store table
+    fs.write_table(
+      name=pickup_feature_table_name,
+      df=pickup_features_df,
+      mode="merge",
+    )
+
+    # The February drop off windows all land in one partition and can't overlap the January rows already written,
+    # so replace that partition of the underlying Delta table directly. This bypasses the Feature Store client.
+    write_feature_partition(dropoff_feature_table_name, dropoff_features_df, yyyy_mm)
 
 # COMMAND ----------
 
@@ -330,52 +402,40 @@ spark.sql(sqlCommand).display()
 
 # COMMAND ----------
 
+import builtins
 from pyspark.sql import *
 from pyspark.sql.functions import current_timestamp
 from pyspark.sql.types import IntegerType
-import math
-from datetime import timedelta
 import mlflow.pyfunc
 
 
-def rounded_unix_timestamp(dt, num_minutes=15):
+def rounded_unix_timestamp(ts_col, num_minutes=15):
     """
-    Ceilings datetime dt to interval num_minutes, then returns the unix timestamp.
+    Ceilings timestamp column ts_col to interval num_minutes, then returns the unix timestamp.
     """
-    nsecs = dt.minute * 60 + dt.second + dt.microsecond * 1e-6
-    delta = math.ceil(nsecs / (60 * num_minutes)) * (60 * num_minutes) - nsecs
-    return int((dt + timedelta(seconds=delta)).timestamp())
-
-
-rounded_unix_timestamp_udf = udf(rounded_unix_timestamp, IntegerType())
+    # Casting to double keeps sub-second precision, so a timestamp just past a boundary still rounds up.
+    interval = lit(60 * num_minutes)
+    return (ceil(ts_col.cast("double") / interval) * interval).cast(IntegerType())
 
 
 def rounded_taxi_data(taxi_data_df):
     # Round the taxi data timestamp to 15 and 30 minute intervals so we can join with the pickup and dropoff features
-    # respectively.
-    taxi_data_df = (
-        taxi_data_df.withColumn(
-            "rounded_pickup_datetime",
-            rounded_unix_timestamp_udf(taxi_data_df["tpep_pickup_datetime"], lit(15)),
-        )
-        .withColumn(
-            "rounded_dropoff_datetime",
-            rounded_unix_timestamp_udf(taxi_data_df["tpep_dropoff_datetime"], lit(30)),
-        )
-        .drop("tpep_pickup_datetime")
-        .drop("tpep_dropoff_datetime")
-    )
+    # respectively. A single select keeps this to one projection in the plan.
+    cols = [
+        c for c in taxi_data_df.columns if c not in ("tpep_pickup_datetime", "tpep_dropoff_datetime")
+    ] + [
+        rounded_unix_timestamp(taxi_data_df["tpep_pickup_datetime"], 15).alias("rounded_pickup_datetime"),
+        rounded_unix_timestamp(taxi_data_df["tpep_dropoff_datetime"], 30).alias("rounded_dropoff_datetime"),
+    ]
+    taxi_data_df = taxi_data_df.select(*cols)
     taxi_data_df.createOrReplaceTempView("taxi_data")
     return taxi_data_df
   
 def get_latest_model_version(model_name):
-    latest_version = 1
     mlflow_client = MlflowClient()
-    for mv in mlflow_client.search_model_versions(f"name='{model_name}'"):
-      version_int = int(mv.version)
-      if version_int > latest_version:
-        latest_version = version_int
-    return latest_version
+    versions = [int(mv.version) for mv in mlflow_client.search_model_versions(f"name='{model_name}'")]
+    # builtins.max, since pyspark.sql.functions.max shadows it after the wildcard import above.
+    return builtins.max(versions, default=1)
 
 # COMMAND ----------
 
@@ -383,7 +443,8 @@ def get_latest_model_version(model_name):
 
 # COMMAND ----------
 
-taxi_data = rounded_taxi_data(raw_data)
+# Cached since the same rounded data is reused for training and for batch scoring below.
+taxi_data = rounded_taxi_data(raw_data).persist(StorageLevel.MEMORY_AND_DISK)
 
 # COMMAND ----------
 
@@ -443,12 +504,26 @@ dropoff_feature_lookups = [
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC If the training set join shuffles the taxi data, for example because the feature tables outgrow the broadcast threshold set below, larger shuffle buffers cut reducer fetch round-trips and how often map tasks flush to disk. Shuffle settings are cluster-level Spark configs that can't be changed from a running notebook, so add these lines to the cluster's **Spark config** (under **Advanced options**) before running this notebook. They raise the defaults of `48m` and `32k`:
+# MAGIC
+# MAGIC ```
+# MAGIC spark.reducer.maxSizeInFlight 96m
+# MAGIC spark.shuffle.file.buffer 1m
+# MAGIC ```
+
+# COMMAND ----------
+
 # End any existing runs (in the case this notebook is being run for a second time)
 mlflow.end_run()
 
 # Start an mlflow run, which is needed for the feature store to log the model
 mlflow.start_run() 
 
+# The feature tables are small per-zip, per-window aggregates, so let the training set join broadcast them
+# instead of shuffling the much larger taxi data.
+spark.conf.set("spark.sql.autoBroadcastJoinThreshold", str(200 * 1024 * 1024))
+
 # Since the rounded timestamp columns would likely cause the model to overfit the data 
 # unless additional feature engineering was performed, exclude them to avoid training on them.
 exclude_columns = ["rounded_pickup_datetime", "rounded_dropoff_datetime"]
@@ -461,8 +536,10 @@ training_set = fs.create_training_set(
   exclude_columns = exclude_columns
 )
 
-# Load the TrainingSet into a dataframe which can be passed into sklearn for training a model
-training_df = training_set.load_df()
+# Load the TrainingSet into a dataframe which can be passed into sklearn for training a model.
+# Cache it so the feature join runs once for both the display and the Pandas conversion below.
+training_df = training_set.load_df().persist(StorageLevel.MEMORY_AND_DISK)
+training_df.count()
 
 # COMMAND ----------
 
@@ -476,6 +553,8 @@ display(training_df)
 
 # COMMAND ----------
 
+import os
+import numpy as np
 from sklearn.model_selection import train_test_split
 from mlflow.tracking import MlflowClient
 import lightgbm as lgb
@@ -484,20 +563,35 @@ from mlflow.models.signature import infer_signature
 
 features_and_label = training_df.columns
 
+# Transfer data to Pandas as Arrow record batches instead of pickled rows, falling back if a type is unsupported
+spark.conf.set("spark.sql.execution.arrow.pyspark.enabled", "true")
+spark.conf.set("spark.sql.execution.arrow.pyspark.fallback.enabled", "true")
+
 # Collect data into a Pandas array for training
-data = training_df.toPandas()[features_and_label]
+data = training_df.select(*features_and_label).toPandas()
 
-train, test = train_test_split(data, random_state=123)
-X_train = train.drop(["fare_amount"], axis=1)
-X_test = test.drop(["fare_amount"], axis=1)
-y_train = train.fare_amount
-y_test = test.fare_amount
+# Convert once to float32 NumPy arrays, which LightGBM consumes without another DataFrame copy
+feature_names = [c for c in features_and_label if c != "fare_amount"]
+X = data[feature_names].to_numpy(dtype=np.float32)
+y = data["fare_amount"].to_numpy(dtype=np.float32)
 
-mlflow.lightgbm.autolog()
-train_lgb_dataset = lgb.Dataset(X_train, label=y_train.values)
-test_lgb_dataset = lgb.Dataset(X_test, label=y_test.values)
+X_train, X_test, y_train, y_test = train_test_split(X, y, random_state=123)
 
-param = {"num_leaves": 32, "objective": "regression", "metric": "rmse"}
+mlflow.lightgbm.autolog()
+train_lgb_dataset = lgb.Dataset(X_train, label=y_train, feature_name=feature_names, free_raw_data=True)
+test_lgb_dataset = lgb.Dataset(X_test, label=y_test, feature_name=feature_names, free_raw_data=True)
+
+param = {
+  "num_leaves": 32,
+  "objective": "regression",
+  "metric": "rmse",
+  # Use every driver core and a fixed column-wise histogram layout, skipping LightGBM's layout auto-detection.
+  "num_threads": os.cpu_count(),
+  "force_col_wise": True,
+  "max_bin": 255,
+  "min_data_in_leaf": 20,
+  "verbose": -1,
+}
 num_rounds = 100
 
 # Train a lightGBM model
@@ -505,6 +599,8 @@ model = lgb.train(
   param, train_lgb_dataset, num_rounds
 )
 
+training_df.unpersist()
+
 # COMMAND ----------
 
 # Log the trained model with MLflow and package it with feature lookup information.
@@ -533,7 +629,9 @@ fs.log_model(
 
 # COMMAND ----------
 
-new_taxi_data = rounded_taxi_data(raw_data)
+# This example scores the same batch of taxi data used for training, so reuse the already rounded DataFrame.
+# For a genuinely new batch, pass that data through rounded_taxi_data instead.
+new_taxi_data = taxi_data
 
 # COMMAND ----------
 